@@ -2,17 +2,25 @@
 # We need this for older python versions, otherwise it will not use the wavedrom module
 from __future__ import absolute_import
 
+from glob import glob
 from os import path
 
+from html import escape
+
 from docutils import nodes
 from docutils.parsers.rst import directives
 from docutils.parsers.rst.directives.images import Image
 from sphinx.ext.graphviz import figure_wrapper
 from sphinx.util.fileutil import copy_asset_file
 from sphinx.locale import __
+from sphinx.util import logging
 from sphinx.util.docutils import SphinxDirective
 from sphinx.util.i18n import search_image_for_language
-from .wavedrom_render_image import render_wavedrom_image
+from .wavedrom_render_image import render_wavedrom_image, render_wavedrom_gallery, get_image_node
+from .wavedrom_render_throttle import reset_render_queueing, report_render_queueing
+from .wavedrom_render_fallback import reset_fallback_report, report_fallbacks
+
+logger = logging.getLogger(__name__)
 
 ONLINE_SKIN_JS = "{url}/skins/default.js"
 ONLINE_WAVEDROM_JS = "{url}/wavedrom.min.js"
@@ -25,6 +33,19 @@ WAVEDROM_HTML = """
 </div>
 """
 
+WAVEDROM_GALLERY_HTML = """
+<figure class="wavedrom-gallery-item">
+<div style="overflow-x:auto">
+<script type="WaveDrom">
+{content}
+</script>
+</div>
+<figcaption>{caption}</figcaption>
+</figure>
+"""
+
+WAVEDROM_GALLERY_GRID_STYLE = "display:grid;grid-template-columns:repeat({columns},minmax(0,1fr));gap:1em"
+
 class WavedromNode(nodes.General, nodes.Inline, nodes.Element):
     """
     Special node for wavedrom figures. It is not used for inline javascript.
@@ -102,6 +123,172 @@ class WavedromDirective(Image, SphinxDirective):
 
         return [node]
 
+class WavedromGalleryNode(nodes.General, nodes.Element):
+    """
+    Node grouping the wavedrom figures of a gallery, so they can be rendered in one go.
+    """
+    # pass
+
+
+def gallery_files(srcdir, rel_pattern):
+    """
+    Returns the files matching a gallery pattern, relative to the source directory
+    """
+    return sorted(path.relpath(filename, srcdir) for filename in glob(path.join(srcdir, rel_pattern))
+                  if path.isfile(filename))
+
+
+def gallery_layout(argument):
+    """
+    Conversion function for the layout option of the wavedrom-gallery directive
+    """
+    return directives.choice(argument, ('grid', 'list'))
+
+
+class WavedromGalleryDirective(Image, SphinxDirective):
+    """
+    Directive to insert all wavedrom files matching a glob pattern as a gallery of captioned figures.
+
+    Each file becomes a wavedrom node like those of the wavedrom directive, accepting the same image options.
+    """
+    has_content = False
+
+    required_arguments = 1
+    optional_arguments = 0
+    final_argument_whitespace = False
+
+    option_spec = Image.option_spec.copy()
+    option_spec['layout'] = gallery_layout
+    option_spec['columns'] = directives.positive_int
+
+    def run(self):
+        document = self.state.document
+        pattern = self.arguments[0]
+        rel_pattern, _abs_pattern = self.env.relfn2path(pattern)
+        filenames = gallery_files(self.env.srcdir, rel_pattern)
+
+        # Remember the matches, so the document is read again when files are added or removed
+        if not hasattr(self.env, 'wavedrom_galleries'):
+            self.env.wavedrom_galleries = {}
+        self.env.wavedrom_galleries.setdefault(self.env.docname, {})[str(rel_pattern)] = filenames
+
+        if not filenames:
+            return [document.reporter.warning(
+                __('No wavedrom files match the pattern %r') % pattern, line=self.lineno)]
+
+        layout = self.options.pop('layout', 'grid')
+        columns = self.options.pop('columns', 2)
+        name = self.options.pop('name', None)
+        # The image options apply to each image, but the name belongs to the gallery
+        self.arguments = ["dummy"]
+
+        diagrams, messages = self.read_diagrams(filenames)
+
+        # For html output with inline JS enabled, just return plain HTML
+        if (self.env.app.builder.name in ('html', 'dirhtml', 'singlehtml') and self.config.wavedrom_html_jsinline):
+            gallery = self.raw_gallery(diagrams, layout, columns)
+        else:
+            gallery = self.figure_gallery(diagrams, layout, columns)
+
+        if name:
+            self.options['name'] = name
+            self.add_name(gallery)
+        return [gallery] + messages
+
+    def read_diagrams(self, filenames):
+        """
+        Reads the wavedrom files of the gallery (relative to the source directory), registering each as a dependency
+        of the document.
+
+        Returns a list of (caption, code) tuples and a list of warnings for the files that could not be read.
+        """
+        diagrams = []
+        messages = []
+        for rel_filename in filenames:
+            self.env.note_dependency(rel_filename)
+            filename = path.join(self.env.srcdir, rel_filename)
+            try:
+                with open(filename, 'r') as file_pointer:  # type: ignore
+                    code = file_pointer.read()
+            except (IOError, OSError, UnicodeError):
+                # Leave out this file only, not the rest of the gallery
+                messages.append(self.state.document.reporter.warning(
+                    __('External wavedrom json file %r not found or reading '
+                       'it failed') % filename, line=self.lineno))
+                continue
+            diagrams.append((path.splitext(path.basename(filename))[0], code))
+        return diagrams, messages
+
+    @staticmethod
+    def gallery_classes(layout):
+        """
+        Returns the classes of the element laying out a gallery
+        """
+        return ['wavedrom-gallery', 'wavedrom-gallery-{}'.format(layout)]
+
+    def figure_gallery(self, diagrams, layout, columns):
+        """
+        Builds a gallery node holding a captioned figure with a wavedrom node for every diagram.
+        """
+        gallery = WavedromGalleryNode()
+        gallery['layout'] = layout
+        gallery['columns'] = columns
+        gallery['classes'] += self.gallery_classes(layout)
+        for caption, code in diagrams:
+            node = WavedromNode()
+            node['code'] = code
+            (node['image_node'],) = Image.run(self)
+            # Filenames are not parsed as inline markup, they may well contain underscores
+            gallery += nodes.figure('', node, nodes.caption(caption, caption), classes=['wavedrom-gallery-item'])
+        return gallery
+
+    def raw_gallery(self, diagrams, layout, columns):
+        """
+        Builds the plain HTML of a gallery for rendering by the browser.
+        """
+        style = ''
+        if layout == 'grid':
+            style = ' style="{}"'.format(WAVEDROM_GALLERY_GRID_STYLE.format(columns=columns))
+        items = ''.join(WAVEDROM_GALLERY_HTML.format(content=code, caption=escape(caption))
+                        for caption, code in diagrams)
+        text = '<div class="{}"{}>\n{}</div>\n'.format(' '.join(self.gallery_classes(layout)), style, items)
+        gallery = nodes.container('', nodes.raw(text=text, format='html'))
+        gallery['classes'] += ['wavedrom-gallery-container']
+        return gallery
+
+def purge_galleries(_app, env, docname):
+    """
+    Forgets the galleries of a document that is about to be read again or was removed
+    """
+    if hasattr(env, 'wavedrom_galleries'):
+        env.wavedrom_galleries.pop(docname, None)
+
+
+def merge_galleries(_app, env, docnames, other):
+    """
+    Merges the galleries found by a parallel reading process
+    """
+    if not hasattr(other, 'wavedrom_galleries'):
+        return
+    if not hasattr(env, 'wavedrom_galleries'):
+        env.wavedrom_galleries = {}
+    for docname in docnames:
+        if docname in other.wavedrom_galleries:
+            env.wavedrom_galleries[docname] = other.wavedrom_galleries[docname]
+
+
+def outdated_galleries(_app, env, _added, _changed, removed):
+    """
+    Marks documents as outdated when files were added to or removed from one of their galleries. Changes to the
+    files themselves are covered by the dependencies of the document.
+    """
+    if not hasattr(env, 'wavedrom_galleries'):
+        return []
+    return [docname for docname, galleries in env.wavedrom_galleries.items()
+            if docname not in removed and
+            any(gallery_files(env.srcdir, rel_pattern) != filenames for rel_pattern, filenames in galleries.items())]
+
+
 def builder_inited(app):
     """
     Sets wavedrom_html_jsinline to False for all non-html builders for
@@ -111,7 +298,14 @@ def builder_inited(app):
     Depending on the settings provided in the configuration, we take either
     the online files from the wavedrom server, or the locally provided wavedrom
     javascript files
+
+    It also checks render_using_wavedrompy, as any string would otherwise select wavedrompy
     """
+    if app.config.render_using_wavedrompy not in (True, False, 'auto'):
+        logger.warning(__('render_using_wavedrompy must be True, False or "auto", got %r. Using wavedrom-cli.'),
+                       app.config.render_using_wavedrompy)
+        app.config.render_using_wavedrompy = False
+
     if (app.config.wavedrom_html_jsinline and app.builder.name not in ('html', 'dirhtml', 'singlehtml')):
         app.config.wavedrom_html_jsinline = False
 
@@ -182,6 +376,83 @@ def visit_wavedrom(sphinx, node):
     render_wavedrom_image(sphinx, node)
     raise nodes.SkipDeparture
 
+def visit_wavedrom_html(sphinx, node):
+    '''WavedromNode visit function for html output. Generates the image like visit_wavedrom, but keeps the departure
+    so the emitted img tag can be annotated.
+
+    Args:
+        sphinx (sphinx): Sphinx instance
+        node (WavedromNode): WavedromNode that is being processed
+    '''
+    render_wavedrom_image(sphinx, node)
+    node['body_index'] = len(sphinx.body)
+
+def depart_wavedrom_html(sphinx, node):
+    '''WavedromNode departure function for html output. Adds native lazy-loading and asynchronous decoding to the img
+    tag that was written for the child image node.
+
+    Args:
+        sphinx (sphinx): Sphinx instance
+        node (WavedromNode): WavedromNode that is being processed
+    '''
+    attributes = ' decoding="async"'
+    # Leave an explicit :loading: option (docutils >= 0.21) alone
+    if 'loading' not in get_image_node(node):
+        attributes = ' loading="lazy"' + attributes
+    for index in range(node['body_index'], len(sphinx.body)):
+        tag = sphinx.body[index]
+        if tag.startswith('<img '):
+            # Intrinsic width and height attributes only reserve the space; let themes that limit the width keep the
+            # aspect ratio. Sizes set by the author are left as they are.
+            if node.get('intrinsic_size') and ' style="' not in tag:
+                attributes += ' style="height: auto;"'
+            sphinx.body[index] = '<img' + attributes + tag[len('<img'):]
+            break
+
+def _gallery_wavedrom_nodes(node):
+    """
+    Returns the wavedrom nodes of a gallery
+    """
+    return [child for figure in node.children for child in figure.children if isinstance(child, WavedromNode)]
+
+def visit_wavedrom_gallery(sphinx, node):
+    '''WavedromGalleryNode visit function. Renders the images of all wavedrom nodes in the gallery at once, the
+    nodes themselves are visited afterwards.
+
+    Args:
+        sphinx (sphinx): Sphinx instance
+        node (WavedromGalleryNode): WavedromGalleryNode that is being processed
+
+    Raises:
+        SkipDeparture: Highlights to sphinx that a departure callback is not needed
+    '''
+    render_wavedrom_gallery(sphinx, _gallery_wavedrom_nodes(node))
+    raise nodes.SkipDeparture
+
+def visit_wavedrom_gallery_html(sphinx, node):
+    '''WavedromGalleryNode visit function for html output. Renders the gallery like visit_wavedrom_gallery and opens
+    the element that lays out its figures.
+
+    Args:
+        sphinx (sphinx): Sphinx instance
+        node (WavedromGalleryNode): WavedromGalleryNode that is being processed
+    '''
+    render_wavedrom_gallery(sphinx, _gallery_wavedrom_nodes(node))
+    if node['layout'] == 'grid':
+        sphinx.body.append(sphinx.starttag(
+            node, 'div', style=WAVEDROM_GALLERY_GRID_STYLE.format(columns=node['columns'])))
+    else:
+        sphinx.body.append(sphinx.starttag(node, 'div'))
+
+def depart_wavedrom_gallery_html(sphinx, _node):
+    '''WavedromGalleryNode departure function for html output. Closes the layout element.
+
+    Args:
+        sphinx (sphinx): Sphinx instance
+        _node (WavedromGalleryNode): WavedromGalleryNode that is being processed
+    '''
+    sphinx.body.append('</div>\n')
+
 def setup(app):
     """
     Setup the extension
@@ -191,17 +462,34 @@ def setup(app):
     app.add_config_value('online_wavedrom_js_url', "https://wavedrom.com", 'html')
     app.add_config_value('wavedrom_html_jsinline', True, 'html')
     app.add_config_value('wavedrom_cli', "npx wavedrom-cli", 'html')
-    app.add_config_value('render_using_wavedrompy', False, 'html')
+    app.add_config_value('render_using_wavedrompy', False, 'html', [bool, str])
+    app.add_config_value('wavedrom_cli_timeout', 0, '')
+    app.add_config_value('wavedrom_cli_max_parallel_renders', 0, '')
+    app.add_config_value('wavedrom_cli_max_memory', 0, '')
+    app.add_config_value('wavedrompy_max_parallel_renders', 0, '')
     app.add_directive('wavedrom', WavedromDirective)
+    app.add_directive('wavedrom-gallery', WavedromGalleryDirective)
     app.connect('build-finished', build_finished)
+    app.connect('build-finished', report_render_queueing)
+    app.connect('build-finished', report_fallbacks)
     app.connect('builder-inited', builder_inited)
+    app.connect('env-purge-doc', purge_galleries)
+    app.connect('env-merge-info', merge_galleries)
+    app.connect('env-get-outdated', outdated_galleries)
+    app.connect('builder-inited', reset_render_queueing)
+    app.connect('builder-inited', reset_fallback_report)
     app.connect('doctree-resolved', doctree_resolved)
 
     app.add_node(WavedromNode,
-                 html=(visit_wavedrom, None),
+                 html=(visit_wavedrom_html, depart_wavedrom_html),
                  latex=(visit_wavedrom, None),
                  confluence=(visit_wavedrom, None),
                  )
+    app.add_node(WavedromGalleryNode,
+                 html=(visit_wavedrom_gallery_html, depart_wavedrom_gallery_html),
+                 latex=(visit_wavedrom_gallery, None),
+                 confluence=(visit_wavedrom_gallery, None),
+                 )
 
     return {
         'parallel_read_safe': True,
@@ -0,0 +1,215 @@
+'''Supporting file dedicated to remembering which diagrams needed the wavedrompy fallback of the "auto" engine
+
+Diagrams are identified by a hash of their code and of the wavedrom-cli command and timeout, so changing either gives
+wavedrom-cli another chance. The hashes are kept in a file next to the doctrees, so they survive between incremental
+builds and are forgotten on a clean build. Every render that used the fallback is also logged to a per-build file,
+which all parallel workers append to and which is summarised when the build finishes.
+
+A diagram is only remembered once wavedrom-cli is known to work, i.e. it rendered a diagram with the same command in
+this or an earlier build. After a timeout or a missing command, wavedrom-cli is not tried for the rest of the build.
+Both facts are kept in marker files, so that all parallel workers see them. A diagram that timed out before
+wavedrom-cli was known to work is remembered as a suspect instead: it skips wavedrom-cli until other diagrams have shown
+that wavedrom-cli works, after which a new timeout pins it.
+'''
+import hashlib
+import os
+
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+FALLBACK_FILENAME = 'wavedrom-fallback.txt'
+FALLBACK_LOG = 'wavedrom-fallback.log'
+CLI_WORKED_FILENAME = 'wavedrom-cli-worked.txt'
+CLI_UNAVAILABLE_FILENAME = 'wavedrom-cli-unavailable'
+SUSPECTS_FILENAME = 'wavedrom-cli-suspects.txt'
+
+# Hashes known to need the fallback and suspects, loaded once per process
+_KNOWN_KEYS = {}
+
+
+def _diagram_key(builder, code):
+    '''Function for identifying a diagram rendered with the current wavedrom-cli configuration
+
+    Args:
+        builder (Builder): Sphinx builder
+        code (str): The wavedrom json content of the diagram
+
+    Returns:
+        str: A hash of the diagram code, the wavedrom-cli command and its timeout
+    '''
+    config = builder.config
+    identity = '{}\n{}\n{}'.format(config.wavedrom_cli, config.wavedrom_cli_timeout, code)
+    return hashlib.sha1(identity.encode('utf-8')).hexdigest()
+
+
+def _known_keys(builder, filename):
+    '''Function for loading the hashes of the diagrams recorded in a file by earlier builds
+
+    Args:
+        builder (Builder): Sphinx builder
+        filename (str): FALLBACK_FILENAME or SUSPECTS_FILENAME
+
+    Returns:
+        set: The recorded hashes
+    '''
+    fpath = os.path.join(builder.doctreedir, filename)
+    if fpath not in _KNOWN_KEYS:
+        known = set()
+        if os.path.exists(fpath):
+            with open(fpath, 'r') as keys_file:
+                known = set(line.strip() for line in keys_file if line.strip())
+        _KNOWN_KEYS[fpath] = known
+    return _KNOWN_KEYS[fpath]
+
+
+def _add_key(builder, filename, key):
+    '''Function for recording the hash of a diagram in a file for later builds
+
+    Args:
+        builder (Builder): Sphinx builder
+        filename (str): FALLBACK_FILENAME or SUSPECTS_FILENAME
+        key (str): The hash of the diagram
+
+    Returns:
+        bool: True when the hash was not recorded yet
+    '''
+    known = _known_keys(builder, filename)
+    if key in known:
+        return False
+    known.add(key)
+    with open(os.path.join(builder.doctreedir, filename), 'a') as keys_file:
+        keys_file.write(key + '\n')
+    return True
+
+
+def needs_fallback(builder, code):
+    '''Function for checking whether a diagram needed the fallback before
+
+    Args:
+        builder (Builder): Sphinx builder
+        code (str): The wavedrom json content of the diagram
+
+    Returns:
+        bool: True when the diagram should be rendered with the fallback engine straight away
+    '''
+    return _diagram_key(builder, code) in _known_keys(builder, FALLBACK_FILENAME)
+
+
+def is_suspect(builder, code):
+    '''Function for checking whether a diagram timed out before wavedrom-cli was known to work
+
+    Args:
+        builder (Builder): Sphinx builder
+        code (str): The wavedrom json content of the diagram
+
+    Returns:
+        bool: True when the diagram is a suspect
+    '''
+    return _diagram_key(builder, code) in _known_keys(builder, SUSPECTS_FILENAME)
+
+
+def mark_suspect(builder, code):
+    '''Function for recording that a diagram timed out before wavedrom-cli was known to work
+
+    Args:
+        builder (Builder): Sphinx builder
+        code (str): The wavedrom json content of the diagram
+    '''
+    _add_key(builder, SUSPECTS_FILENAME, _diagram_key(builder, code))
+
+
+def record_fallback(builder, code, remember=True):
+    '''Function for recording that a diagram was rendered with the fallback engine
+
+    Args:
+        builder (Builder): Sphinx builder
+        code (str): The wavedrom json content of the diagram
+        remember (bool): Whether later builds should use the fallback straight away. False when wavedrom-cli was
+            unavailable rather than failing on the diagram.
+    '''
+    key = _diagram_key(builder, code)
+    if not remember:
+        status = 'unavailable'
+    elif _add_key(builder, FALLBACK_FILENAME, key):
+        status = 'new'
+    else:
+        status = 'known'
+    with open(os.path.join(builder.doctreedir, FALLBACK_LOG), 'a') as fallback_log:
+        fallback_log.write('{} {}\n'.format(status, key))
+
+
+def cli_has_worked(builder):
+    '''Function for checking whether the configured wavedrom-cli command ever rendered a diagram
+
+    Args:
+        builder (Builder): Sphinx builder
+
+    Returns:
+        bool: True when wavedrom-cli rendered a diagram with the current command in this or an earlier build
+    '''
+    fpath = os.path.join(builder.doctreedir, CLI_WORKED_FILENAME)
+    if not os.path.exists(fpath):
+        return False
+    with open(fpath, 'r') as cli_worked_file:
+        return cli_worked_file.read() == builder.config.wavedrom_cli
+
+
+def mark_cli_worked(builder):
+    '''Function for recording that the configured wavedrom-cli command rendered a diagram
+
+    Args:
+        builder (Builder): Sphinx builder
+    '''
+    if not cli_has_worked(builder):
+        with open(os.path.join(builder.doctreedir, CLI_WORKED_FILENAME), 'w') as cli_worked_file:
+            cli_worked_file.write(builder.config.wavedrom_cli)
+
+
+def cli_unavailable(builder):
+    '''Function for checking whether wavedrom-cli was given up on for the rest of this build
+
+    Args:
+        builder (Builder): Sphinx builder
+
+    Returns:
+        bool: True after wavedrom-cli timed out or could not be found in this build
+    '''
+    return os.path.exists(os.path.join(builder.doctreedir, CLI_UNAVAILABLE_FILENAME))
+
+
+def mark_cli_unavailable(builder):
+    '''Function for giving up on wavedrom-cli for the rest of this build
+
+    Args:
+        builder (Builder): Sphinx builder
+    '''
+    with open(os.path.join(builder.doctreedir, CLI_UNAVAILABLE_FILENAME), 'w'):
+        pass
+
+
+def reset_fallback_report(app):
+    '''
+    Clears the fallback log and the unavailability of wavedrom-cli of a previous build and forgets the hashes cached by
+    this process
+    '''
+    _KNOWN_KEYS.clear()
+    for filename in (FALLBACK_LOG, CLI_UNAVAILABLE_FILENAME):
+        fpath = os.path.join(app.doctreedir, filename)
+        if os.path.exists(fpath):
+            os.remove(fpath)
+
+
+def report_fallbacks(app, _exception):
+    '''
+    When the build is finished, we report how many diagrams were rendered with the fallback engine
+    '''
+    fallback_log = os.path.join(app.doctreedir, FALLBACK_LOG)
+    if not os.path.exists(fallback_log):
+        return
+    with open(fallback_log, 'r') as fallback_log_file:
+        statuses = [line.split()[0] for line in fallback_log_file if line.strip()]
+    os.remove(fallback_log)
+    logger.info('wavedrom: %d diagrams rendered using the wavedrompy fallback '
+                '(%d new, %d with wavedrom-cli unavailable)',
+                len(statuses), statuses.count('new'), statuses.count('unavailable'))
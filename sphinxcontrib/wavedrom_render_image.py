@@ -1,11 +1,18 @@
 '''Supporting file dedicated to the generation of wavedrom images using the official wavedrom-cli executable '''
+import hashlib
 import os
 import subprocess
+from glob import glob, escape as glob_escape
 import shlex
+import re
+import signal
 from uuid import uuid4
+from xml.etree import ElementTree
 import cairosvg
+from docutils import nodes
 from wavedrom import render
 from sphinx.errors import SphinxError
+from sphinx.util import logging
 import errno
 
 # This exception was not always available..
@@ -15,9 +22,30 @@ except ImportError:
     JSONDecodeError = ValueError
 
 from sphinx.util.osutil import ensuredir
+from .wavedrom_render_throttle import render_slot
+from .wavedrom_render_fallback import (needs_fallback, record_fallback, cli_has_worked, mark_cli_worked,
+                                       cli_unavailable, mark_cli_unavailable, is_suspect, mark_suspect)
+
+try:
+    from sphinx.util.images import get_image_size
+except ImportError:
+    get_image_size = None
 
 ENOENT = getattr(errno, 'ENOENT', 0)
 
+IMAGE_EXTENSIONS = {
+    'image/svg+xml': 'svg',
+    'application/pdf': 'pdf',
+    'image/png': 'png',
+}
+
+# Timeout in seconds for wavedrom-cli renders in auto mode, unless wavedrom_cli_timeout is set
+AUTO_CLI_TIMEOUT = 60
+
+SVG_LENGTH = re.compile(r'^\s*([0-9.]+)\s*(px)?\s*$')
+
+logger = logging.getLogger(__name__)
+
 def determine_format(supported):
     """
     Determine the proper format to render
@@ -74,23 +102,278 @@ def render_wavedrom_image(sphinx, node):
     if image_format is None:
         raise SphinxError("Cannot determine a suitable output format")
 
-    # Create random filename
-    bname = "wavedrom-{}".format(uuid4())
     outpath = os.path.join(sphinx.builder.outdir, sphinx.builder.imagedir)
 
-    # Render the wavedrom image
-    if sphinx.builder.config.render_using_wavedrompy:
-        imgname = render_wavedrom_py(node, outpath, bname, image_format)
-    else:
-        imgname = render_wavedrom_cli(sphinx, node, outpath, bname, image_format)
+    # Nodes of a gallery were already rendered together with the rest of the gallery
+    imgname = node.get('imgname')
+    if imgname is None:
+        # Create random filename
+        bname = "wavedrom-{}".format(uuid4())
+
+        # Render the wavedrom image
+        if sphinx.builder.config.render_using_wavedrompy == 'auto':
+            render_wavedrom_auto(sphinx, [(node, {'wavedrom-cli': bname, 'wavedrompy': bname})], outpath,
+                                 image_format)
+            imgname = node['imgname']
+        elif sphinx.builder.config.render_using_wavedrompy:
+            with render_slot(sphinx.builder, 'wavedrompy'):
+                imgname = render_wavedrom_py(node, outpath, bname, image_format)
+        else:
+            with render_slot(sphinx.builder, 'wavedrom-cli'):
+                imgname = render_wavedrom_cli(sphinx, node, outpath, bname, image_format)
 
     # Now we unpack the image node again. The file was created at the build destination,
     # and we can now use the standard visitor for the image node. We add the image node
     # as a child and then raise a SkipDepature, which will trigger the builder to visit
     # children.
-    image_node = node['image_node']
+    image_node = get_image_node(node)
     image_node['uri'] = os.path.join(sphinx.builder.imgpath, imgname)
-    node.append(image_node)
+
+    # Give the image its intrinsic dimensions, unless the author sized it. Writers apply :scale: on top of these.
+    if 'width' not in image_node and 'height' not in image_node:
+        size = get_wavedrom_image_size(os.path.join(outpath, imgname), image_format)
+        if size is not None:
+            image_node['width'] = str(size[0])
+            image_node['height'] = str(size[1])
+            node['intrinsic_size'] = True
+
+    node.append(node['image_node'])
+
+def get_image_node(node):
+    '''Function for finding the image node of a wavedrom node
+
+    Args:
+        node (wavedromnode): The wavedrom node
+
+    Returns:
+        nodes.image: The image node. With a :target: option, the node stored in the wavedrom node is a reference
+        wrapping it.
+    '''
+    image_node = node['image_node']
+    if isinstance(image_node, nodes.image):
+        return image_node
+    return image_node.next_node(nodes.image)
+
+def _gallery_bname(config, engine, code):
+    '''Function for naming the image of a gallery diagram
+
+    Args:
+        config (Config): Sphinx configuration
+        engine (str): The engine rendering the diagram, "wavedrom-cli" or "wavedrompy"
+        code (str): The wavedrom json content of the diagram
+
+    Returns:
+        str: The filename (without extension) derived from a hash of the engine, the wavedrom-cli command for that
+        engine and the diagram code
+    '''
+    identity = [engine, code]
+    if engine == 'wavedrom-cli':
+        identity.append(str(config.wavedrom_cli))
+    return "wavedrom-{}".format(hashlib.sha1('\n'.join(identity).encode('utf-8')).hexdigest())
+
+def _gallery_engine(builder, node):
+    '''Function for determining the engine that is expected to render a gallery diagram
+
+    Args:
+        builder (Builder): Sphinx builder
+        node (wavedromnode): The wavedrom node
+
+    Returns:
+        str: "wavedrom-cli" or "wavedrompy"
+    '''
+    engine = builder.config.render_using_wavedrompy
+    if engine == 'auto':
+        return 'wavedrompy' if needs_fallback(builder, node['code']) else 'wavedrom-cli'
+    return 'wavedrompy' if engine else 'wavedrom-cli'
+
+def _move_rendered(outpath, tmp_bnames, tmp_imgname, imgname):
+    '''Function for moving a rendered image to its final name and removing the intermediate files
+
+    The rename is atomic, so an image under its final name is always a complete render, even when a build was
+    interrupted or parallel workers rendered the same diagram.
+
+    Args:
+        outpath (str): The path where the output was written
+        tmp_bnames (dict): The temporary filenames (without extension) the diagram was rendered under, per engine
+        tmp_imgname (str): The filename (without full path) of the rendered image
+        imgname (str): The final filename (without full path) of the image
+    '''
+    os.replace(os.path.join(outpath, tmp_imgname), os.path.join(outpath, imgname))
+    # A failed wavedrom-cli attempt may also have left its input behind
+    for tmp_bname in tmp_bnames.values():
+        for leftover in glob(os.path.join(outpath, glob_escape(tmp_bname) + '.*')):
+            os.remove(leftover)
+
+def render_wavedrom_gallery(sphinx, wavedrom_nodes):
+    '''Function for rendering all diagrams of a gallery as a single job
+
+    The images are named after a hash of the diagram code, the engine rendering it and the wavedrom-cli command, so
+    diagrams that an earlier build already rendered the same way are not rendered again. The remaining diagrams are
+    rendered under temporary names while holding a single render slot, and then moved into place. The visits of the
+    wavedrom nodes afterwards only attach the images.
+
+    Args:
+        sphinx (sphinx): Sphinx instance
+        wavedrom_nodes (list): The wavedrom nodes of the gallery
+    '''
+    image_format = determine_format(sphinx.builder.supported_image_types)
+    if image_format is None:
+        raise SphinxError("Cannot determine a suitable output format")
+
+    outpath = os.path.join(sphinx.builder.outdir, sphinx.builder.imagedir)
+    config = sphinx.builder.config
+    extension = IMAGE_EXTENSIONS[image_format]
+
+    pending = []
+    for node in wavedrom_nodes:
+        imgname = "{}.{}".format(_gallery_bname(config, _gallery_engine(sphinx.builder, node), node['code']), extension)
+        if os.path.exists(os.path.join(outpath, imgname)):
+            node['imgname'] = imgname
+        else:
+            # Unique per render, so parallel workers never write to each other's files
+            tmp_bnames = {engine: "{}-{}".format(_gallery_bname(config, engine, node['code']), uuid4())
+                          for engine in ('wavedrom-cli', 'wavedrompy')}
+            pending.append((node, tmp_bnames))
+    logger.verbose('wavedrom: rendering %d of %d gallery diagrams', len(pending), len(wavedrom_nodes))
+    if not pending:
+        return
+
+    if config.render_using_wavedrompy == 'auto':
+        render_wavedrom_auto(sphinx, pending, outpath, image_format)
+    elif config.render_using_wavedrompy:
+        with render_slot(sphinx.builder, 'wavedrompy'):
+            for node, tmp_bnames in pending:
+                node['imgname'] = render_wavedrom_py(node, outpath, tmp_bnames['wavedrompy'], image_format)
+                node['wavedrom_engine'] = 'wavedrompy'
+    else:
+        with render_slot(sphinx.builder, 'wavedrom-cli'):
+            for node, tmp_bnames in pending:
+                node['imgname'] = render_wavedrom_cli(sphinx, node, outpath, tmp_bnames['wavedrom-cli'], image_format)
+                node['wavedrom_engine'] = 'wavedrom-cli'
+
+    for node, tmp_bnames in pending:
+        engine = node['wavedrom_engine']
+        imgname = "{}.{}".format(_gallery_bname(config, engine, node['code']), extension)
+        _move_rendered(outpath, tmp_bnames, node['imgname'], imgname)
+        node['imgname'] = imgname
+
+def render_wavedrom_auto(sphinx, pending, outpath, image_format):
+    '''Function for generating images using wavedrom-cli, falling back to wavedrompy
+
+    Diagrams for which wavedrom-cli failed or timed out in this or an earlier build are rendered using wavedrompy
+    straight away. After a timeout or a missing command, wavedrom-cli is not tried for the rest of the build. Failed
+    diagrams are only remembered when wavedrom-cli has worked before, so a broken or overloaded environment does not
+    pin them. All wavedrom-cli renders hold a single render slot, as do all wavedrompy renders.
+
+    Args:
+        sphinx (sphinx): Sphinx instance
+        pending (list): (wavedrom node, bnames) tuples of the diagrams to render, bnames mapping each engine to the
+            filename (without extension) to render under. The filename (without full path) of each generated image
+            and the engine that rendered it are stored in the 'imgname' and 'wavedrom_engine' attributes of its node.
+        outpath (str): The path where the output should be written
+        image_format (str): The desired image format
+    '''
+    fallbacks = []
+    cli_pending = []
+    for node, bnames in pending:
+        if needs_fallback(sphinx.builder, node['code']):
+            fallbacks.append((node, bnames, True))
+        else:
+            cli_pending.append((node, bnames))
+
+    if cli_pending:
+        with render_slot(sphinx.builder, 'wavedrom-cli'):
+            for node, bnames in cli_pending:
+                if cli_unavailable(sphinx.builder) or (is_suspect(sphinx.builder, node['code']) and
+                                                       not cli_has_worked(sphinx.builder)):
+                    fallbacks.append((node, bnames, False))
+                    continue
+                try:
+                    node['imgname'] = render_wavedrom_cli(sphinx, node, outpath, bnames['wavedrom-cli'], image_format)
+                    node['wavedrom_engine'] = 'wavedrom-cli'
+                    mark_cli_worked(sphinx.builder)
+                except WavedromNotFoundError as err:
+                    logger.info('wavedrom-cli cannot be run, rendering using wavedrompy for the rest of the build: %s',
+                                str(err).strip(), location=node)
+                    mark_cli_unavailable(sphinx.builder)
+                    fallbacks.append((node, bnames, False))
+                except WavedromTimeoutError as err:
+                    logger.info('wavedrom-cli timed out, rendering using wavedrompy for the rest of the build: %s',
+                                str(err).strip(), location=node)
+                    mark_cli_unavailable(sphinx.builder)
+                    remember = cli_has_worked(sphinx.builder)
+                    if not remember:
+                        mark_suspect(sphinx.builder, node['code'])
+                    fallbacks.append((node, bnames, remember))
+                except SphinxError as err:
+                    logger.info('wavedrom-cli failed, rendering using wavedrompy instead: %s', str(err).strip(),
+                                location=node)
+                    fallbacks.append((node, bnames, cli_has_worked(sphinx.builder)))
+
+    if fallbacks:
+        with render_slot(sphinx.builder, 'wavedrompy'):
+            for node, bnames, remember in fallbacks:
+                node['imgname'] = render_wavedrom_py(node, outpath, bnames['wavedrompy'], image_format)
+                node['wavedrom_engine'] = 'wavedrompy'
+                record_fallback(sphinx.builder, node['code'], remember)
+
+def _svg_length(value):
+    '''Function for converting an svg length attribute to pixels
+
+    Args:
+        value (str): The value of the width or height attribute
+
+    Returns:
+        int: The length in pixels, or None when the value has no unit we can translate to pixels
+    '''
+    match = SVG_LENGTH.match(value or '')
+    if match is None:
+        return None
+    return int(round(float(match.group(1))))
+
+def _svg_size(fpath):
+    '''Function for reading the dimensions of an svg file
+
+    Only the root element is parsed. The width and height attributes are used when present, the viewBox otherwise.
+
+    Args:
+        fpath (str): Full path of the svg file
+
+    Returns:
+        tuple: (width, height) in pixels, or None when they cannot be determined
+    '''
+    try:
+        for _event, element in ElementTree.iterparse(fpath, events=('start',)):
+            width = _svg_length(element.get('width'))
+            height = _svg_length(element.get('height'))
+            if width is None or height is None:
+                viewbox = (element.get('viewBox') or '').replace(',', ' ').split()
+                if len(viewbox) != 4:
+                    return None
+                width = _svg_length(viewbox[2])
+                height = _svg_length(viewbox[3])
+            if not width or not height:
+                return None
+            return width, height
+    except (ElementTree.ParseError, OSError):
+        return None
+    return None
+
+def get_wavedrom_image_size(fpath, image_format):
+    '''Function for determining the intrinsic dimensions of a rendered wavedrom image
+
+    Args:
+        fpath (str): Full path of the rendered image
+        image_format (str): The format of the rendered image
+
+    Returns:
+        tuple: (width, height) in pixels, or None for formats without pixel dimensions (pdf) or unreadable files
+    '''
+    if image_format == 'image/svg+xml':
+        return _svg_size(fpath)
+    if image_format == 'image/png' and get_image_size is not None:
+        return get_image_size(fpath)
+    return None
 
 def _ntunquote(string_to_unquote):
     '''Function used to unquote windows strings
@@ -140,6 +423,82 @@ def generate_wavedrom_args(sphinx, input_filename, output_filename):
     args.extend(['-s', output_filename])
     return args
 
+def generate_wavedrom_env(sphinx):
+    ''' Function for constructing the environment of the wavedrom command
+
+    Args:
+        sphinx (sphinx): Sphinx instance
+
+    Returns:
+        dict: The environment for running wavedrom-cli, or None to inherit the environment unchanged
+    '''
+    max_memory = sphinx.builder.config.wavedrom_cli_max_memory
+    if not max_memory:
+        return None
+    env = os.environ.copy()
+    node_options = env.get('NODE_OPTIONS', '')
+    env['NODE_OPTIONS'] = '{} --max-old-space-size={}'.format(node_options, int(max_memory)).strip()
+    return env
+
+def _run_wavedrom(args, env, timeout):
+    '''Function for running the wavedrom command with an optional timeout
+
+    On POSIX systems the command runs in its own session, so that a timeout also kills the node process started by
+    a wrapper like npx.
+
+    Args:
+        args (list): The split wavedrom command
+        env (dict): The environment for the command, or None to inherit it
+        timeout (float): The timeout in seconds, or None to wait indefinitely
+
+    Returns:
+        tuple: The return code and the stderr output of the command
+
+    Raises:
+        subprocess.TimeoutExpired: The command did not finish in time
+    '''
+    process = subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        stdin=subprocess.DEVNULL,
+        env=env,
+        start_new_session=(os.name != 'nt'))
+    try:
+        _stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        if os.name != 'nt':
+            os.killpg(process.pid, signal.SIGKILL)
+        else:
+            process.kill()
+        process.communicate()
+        raise
+    return process.returncode, stderr
+
+class WavedromNotFoundError(SphinxError):
+    '''
+    The wavedrom command could not be found
+    '''
+
+class WavedromTimeoutError(SphinxError):
+    '''
+    The wavedrom command did not finish in time
+    '''
+
+def wavedrom_cli_timeout(config):
+    '''Function for determining the timeout of a wavedrom-cli render
+
+    Args:
+        config (Config): Sphinx configuration
+
+    Returns:
+        float: The timeout in seconds, or None to wait indefinitely
+    '''
+    if config.wavedrom_cli_timeout:
+        return config.wavedrom_cli_timeout
+    if config.render_using_wavedrompy == 'auto':
+        return AUTO_CLI_TIMEOUT
+    return None
+
 WAVEDROM_NOT_FOUND = '''
 Wavedrom command %r cannot be run. Versions >3.0.0 use wavedrom-cli as the default rendering engine for the diagrams,
 which may not be available or installable on your system.
@@ -167,8 +526,9 @@ def render_wavedrom_cli(sphinx, node, outpath, bname, image_format):
 
     Raises:
         OSError: File not found
-        SphinxError: OSError during execution of the wavedrom command
+        WavedromNotFoundError: The wavedrom command cannot be found
         SphinxError: Non-zero return code
+        WavedromTimeoutError: The command exceeded its timeout
         SphinxError: Invalid image format input string
 
     '''
@@ -179,17 +539,19 @@ def render_wavedrom_cli(sphinx, node, outpath, bname, image_format):
     with open(input_json, 'w') as input_json_file:
         input_json_file.write(node['code'])
     try:
-        process = subprocess.run(
+        returncode, stderr = _run_wavedrom(
             generate_wavedrom_args(sphinx, input_json, output_svg),
-            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            stdin=subprocess.DEVNULL,
-            check=False)
+            generate_wavedrom_env(sphinx),
+            wavedrom_cli_timeout(sphinx.builder.config))
     except OSError as err:
         if err.errno != ENOENT:
             raise
-        raise SphinxError(WAVEDROM_NOT_FOUND % sphinx.builder.config.wavedrom_cli)
-    if process.returncode != 0:
-        raise SphinxError('error while running wavedrom\n\n%s' % process.stderr)
+        raise WavedromNotFoundError(WAVEDROM_NOT_FOUND % sphinx.builder.config.wavedrom_cli)
+    except subprocess.TimeoutExpired:
+        raise WavedromTimeoutError('wavedrom did not finish within %s seconds' %
+                                   wavedrom_cli_timeout(sphinx.builder.config))
+    if returncode != 0:
+        raise SphinxError('error while running wavedrom\n\n%s' % stderr)
 
         # SVG can be directly written and is supported on all versions
     if image_format == 'image/svg+xml':
@@ -0,0 +1,169 @@
+'''Supporting file dedicated to limiting the number of concurrent wavedrom renders across all sphinx processes
+
+With parallel writing (sphinx-build -j N) every worker process renders its own diagrams. The render slots are lock
+files in a directory next to the doctrees, so all workers of one build share them. A slot is held by locking its file,
+which the operating system releases automatically should a worker die mid-render.
+'''
+import os
+import time
+from contextlib import contextmanager
+
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+LOCK_DIRNAME = 'wavedrom-locks'
+QUEUE_LOG = 'queued.log'
+POLL_INTERVAL = 0.05
+
+ENGINE_LIMITS = {
+    'wavedrom-cli': 'wavedrom_cli_max_parallel_renders',
+    'wavedrompy': 'wavedrompy_max_parallel_renders',
+}
+
+
+def _lock_dir(builder):
+    '''Function for determining the directory holding the render slots of a build
+
+    Args:
+        builder (Builder): Sphinx builder
+
+    Returns:
+        str: The lock directory, shared by all processes of the build
+    '''
+    return os.path.join(builder.doctreedir, LOCK_DIRNAME)
+
+
+# Slot files are locked with fcntl on POSIX systems and msvcrt on Windows
+try:
+    import fcntl
+except ImportError:
+    import msvcrt
+
+    def _try_lock(file_descriptor):
+        '''Function for taking a lock on an open slot file without blocking
+
+        Args:
+            file_descriptor (int): File descriptor of the slot file
+
+        Returns:
+            bool: True when the lock was obtained
+        '''
+        try:
+            msvcrt.locking(file_descriptor, msvcrt.LK_NBLCK, 1)
+        except OSError:
+            return False
+        return True
+
+    def _unlock(file_descriptor):
+        '''Function for releasing the lock on a slot file
+
+        Args:
+            file_descriptor (int): File descriptor of the slot file
+        '''
+        os.lseek(file_descriptor, 0, os.SEEK_SET)
+        msvcrt.locking(file_descriptor, msvcrt.LK_UNLCK, 1)
+else:
+    def _try_lock(file_descriptor):
+        '''Function for taking a lock on an open slot file without blocking
+
+        Args:
+            file_descriptor (int): File descriptor of the slot file
+
+        Returns:
+            bool: True when the lock was obtained
+        '''
+        try:
+            fcntl.flock(file_descriptor, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        return True
+
+    def _unlock(file_descriptor):
+        '''Function for releasing the lock on a slot file
+
+        Args:
+            file_descriptor (int): File descriptor of the slot file
+        '''
+        fcntl.flock(file_descriptor, fcntl.LOCK_UN)
+
+
+def _acquire_slot(lock_dir, engine, limit):
+    '''Function for waiting until one of the render slots of an engine is free
+
+    Args:
+        lock_dir (str): The lock directory of the build
+        engine (str): The rendering engine
+        limit (int): The number of slots of the engine
+
+    Returns:
+        int: File descriptor of the locked slot file
+    '''
+    slots = [os.open(os.path.join(lock_dir, '{}-{}.lock'.format(engine, index)), os.O_RDWR | os.O_CREAT)
+             for index in range(limit)]
+    while True:
+        for file_descriptor in slots:
+            if _try_lock(file_descriptor):
+                for other in slots:
+                    if other != file_descriptor:
+                        os.close(other)
+                return file_descriptor
+        time.sleep(POLL_INTERVAL)
+
+
+@contextmanager
+def render_slot(builder, engine):
+    '''Context manager that holds one of the build-wide render slots of an engine
+
+    The number of slots is taken from the engine's ``*_max_parallel_renders`` configuration. A limit of 0 disables
+    throttling. Time spent waiting for a slot is reported in the (verbose) build log and accumulated for the summary
+    written by report_render_queueing.
+
+    Args:
+        builder (Builder): Sphinx builder
+        engine (str): The rendering engine, "wavedrom-cli" or "wavedrompy"
+    '''
+    limit = getattr(builder.config, ENGINE_LIMITS[engine])
+    if not limit:
+        yield
+        return
+
+    lock_dir = _lock_dir(builder)
+    if not os.path.exists(lock_dir):
+        os.makedirs(lock_dir, exist_ok=True)
+
+    start = time.time()
+    file_descriptor = _acquire_slot(lock_dir, engine, int(limit))
+    queued = time.time() - start
+    logger.verbose('wavedrom: %s render queued for %.2fs', engine, queued)
+    # Appends this small are atomic, so every worker can log to the same file
+    with open(os.path.join(lock_dir, QUEUE_LOG), 'a') as queue_log:
+        queue_log.write('{:.3f}\n'.format(queued))
+    try:
+        yield
+    finally:
+        _unlock(file_descriptor)
+        os.close(file_descriptor)
+
+
+def reset_render_queueing(app):
+    '''
+    Clears the queueing statistics of a previous build
+    '''
+    queue_log = os.path.join(_lock_dir(app.builder), QUEUE_LOG)
+    if os.path.exists(queue_log):
+        os.remove(queue_log)
+
+
+def report_render_queueing(app, _exception):
+    '''
+    When the build is finished, we report the total time renders spent waiting for a slot
+    '''
+    queue_log = os.path.join(_lock_dir(app.builder), QUEUE_LOG)
+    if not os.path.exists(queue_log):
+        return
+    with open(queue_log, 'r') as queue_log_file:
+        waits = [float(line) for line in queue_log_file if line.strip()]
+    os.remove(queue_log)
+    logger.info('wavedrom: %d throttled renders spent %.2fs queued in total (longest %.2fs)',
+                len(waits), sum(waits), max(waits, default=0.0))